@@ -9,20 +9,54 @@ Provides functions to generate and visualize indefinitely many Simpson reversals
 See README for details.
 """
 
+import os
+import matplotlib
+
+# Set SIMPSON_BACKEND to choose the matplotlib backend, e.g. to Agg to draw
+#   straight to files without opening any windows.
+if os.environ.get('SIMPSON_BACKEND'):
+    matplotlib.use(os.environ['SIMPSON_BACKEND'])
+
 import matplotlib.pyplot as plt
-import itertools
-import more_itertools
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import PolyCollection
+from matplotlib.figure import Figure
+import numpy as np
+import fractions
+import functools
+import multiprocessing
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+
+# Free parameters A, B, C, D of the recipe in reverse_columns (see README).
+# Must have: A, B, C, D in (0, 1), A < B, and C < D.
+# I chose the four values below somewhat arbitrarily, aiming
+#   to get easily interpreted images.
+EXACT_PARAMS = (fractions.Fraction(9, 20), fractions.Fraction(11, 20),
+                fractions.Fraction(9, 20), fractions.Fraction(11, 20))
 
+# The same parameters as floats, for next_layer.
+A, B, C, D = map(float, EXACT_PARAMS)
 
-def reverse_columns(tall_col, short_col):
+
+def reverse_columns(tall_col, short_col, params=(A, B, C, D)):
     """Creates a Simpson reversal by dividing each column in two.
 
     A column is represented as a tuple (height, width). Assumes that tall_col
     is taller than short_col and that the heights are between 0 and 1.
 
+    The heights and widths may also be numpy arrays, in which case each pair
+    of columns is divided elementwise, or Fractions, in which case (given
+    EXACT_PARAMS) the columns are divided exactly.
+
     Args:
         tall_col: Tuple of floats. The height and width of the taller column.
         short_col: Tuple of floats. The height and width of the shorter column.
+        params: Tuple of the free parameters A, B, C, D of the recipe.
 
     Returns:
         Four columns. The first column is taller than the third, and the second
@@ -30,14 +64,7 @@ def reverse_columns(tall_col, short_col):
         equals the area of tall_col, and the sum of the areas of the last two
         columns equals the area of short_col.
     """
-
-    # Must have: A, B, C, D in (0, 1), A < B, and C < D.
-    # I chose the four values below somewhat arbitrarily, aiming
-    #   to get easily interpreted images.
-    A = 9/20
-    B = 11/20
-    C = 9/20
-    D = 11/20
+    A, B, C, D = params
 
     # heights and widths of the given columns
     h_t, w_t = tall_col
@@ -50,8 +77,10 @@ def reverse_columns(tall_col, short_col):
     h_sr = D*h_s
 
     # how far along, as a proportion of its width, to break each given column
-    z_t = (h_t - C*h_s) / ((1 - A)*h_t + A - C*h_s)
-    z_s = (h_s - D*h_s) / ((1 - B)*h_t + B - D*h_s)
+    # These are equations 7 and 8 in the README, written in terms of the new
+    #   heights: e.g. (1 - A)*h_t + A - C*h_s is just h_tl - h_tr.
+    z_t = (h_t - h_tr) / (h_tl - h_tr)
+    z_s = (h_s - h_sr) / (h_sl - h_sr)
 
     # defining the new columns
     tall_l = (h_sl, z_s * w_s)
@@ -62,66 +91,167 @@ def reverse_columns(tall_col, short_col):
     return tall_l, tall_r, short_l, short_r
 
 
+if njit is not None:
+    _reverse_columns_nb = njit(cache=True, fastmath=True)(reverse_columns)
+
+    # Serial on purpose: numba's parallel threads leave the forked process
+    #   pool in draw_layers hung at exit.
+    @njit(cache=True, fastmath=True)
+    def _next_layer_nb(taller, shorter, new_taller, new_shorter):
+        """Compiled counterpart of next_layer, filling in the new arrays."""
+        for i in range(taller.shape[0]):
+            tall_l, tall_r, short_l, short_r = _reverse_columns_nb(
+                (taller[i, 0], taller[i, 1]), (shorter[i, 0], shorter[i, 1]))
+            new_taller[2*i, 0], new_taller[2*i, 1] = tall_l
+            new_taller[2*i + 1, 0], new_taller[2*i + 1, 1] = tall_r
+            new_shorter[2*i, 0], new_shorter[2*i, 1] = short_l
+            new_shorter[2*i + 1, 0], new_shorter[2*i + 1, 1] = short_r
+else:
+    _next_layer_nb = None
+
+
 def next_layer(taller, shorter):
     """Returns the next layer in a Simpson tree.
 
-    A layer in a Simpson tree is a list of two lists. Each list contains columns.
-    Each column in the first list is taller than its counterpart in the second
-    list.
+    A layer in a Simpson tree is a tuple of two arrays of columns, each of
+    shape (n, 2): row i holds the height and width of the i-th column. Each
+    column in the first array is taller than its counterpart in the second
+    array.
+
+    Args:
+        taller: Array of columns.
+        shorter: Array of columns.
+
+    Returns:
+        Tuple of two arrays, each of shape (2n, 2). The first holds the new
+        taller columns, constructed out of the given shorter columns. The
+        second holds the new shorter columns, constructed out of the given
+        taller columns.
+
+    If numba is installed, the columns are divided by a compiled loop;
+    otherwise, by numpy array operations.
+    """
+    taller = np.ascontiguousarray(taller, dtype=np.float64)
+    shorter = np.ascontiguousarray(shorter, dtype=np.float64)
+    n = len(taller)
+
+    # Each column is replaced by its left child then its right child.
+    new_taller = np.empty((2*n, 2))
+    new_shorter = np.empty((2*n, 2))
+
+    if _next_layer_nb is not None:
+        _next_layer_nb(taller, shorter, new_taller, new_shorter)
+        return new_taller, new_shorter
+
+    # Divide every pair of columns at once, passing reverse_columns the
+    #   heights and widths as arrays.
+    tall_l, tall_r, short_l, short_r = reverse_columns(taller.T, shorter.T)
+
+    new_taller[0::2, 0], new_taller[0::2, 1] = tall_l
+    new_taller[1::2, 0], new_taller[1::2, 1] = tall_r
+    new_shorter[0::2, 0], new_shorter[0::2, 1] = short_l
+    new_shorter[1::2, 0], new_shorter[1::2, 1] = short_r
+
+    return new_taller, new_shorter
+
+
+@functools.lru_cache(maxsize=32)
+def _simpson_layers(first_layer, k):
+    """Returns the layers of a Simpson tree, k layers deep, as a tuple.
+
+    Memoized, so a tree k layers deep is grown from the cached tree k - 1
+    layers deep. The arrays are shared between callers, so are read-only.
+    The cache holds on to every layer it has built, until cleared with
+    clear_tree_cache.
+
+    Args:
+        first_layer: Tuple of two tuples of columns, the two initial columns;
+          see _freeze.
+        k: The depth of the tree to be generated.
+    """
+    if k <= 1:
+        layers = ()
+        layer = tuple(np.array(cols, dtype=np.float64)
+                      for cols in first_layer)
+    else:
+        layers = _simpson_layers(first_layer, k-1)
+        layer = next_layer(*layers[-1])
+
+    for cols in layer:
+        cols.flags.writeable = False
+
+    return layers + (layer,)
+
+
+def next_layer_exact(taller, shorter):
+    """Returns the next layer in a Simpson tree, in exact rational arithmetic.
+
+    Like next_layer, but for lists of columns whose heights and widths are
+    Fractions (or ints). The new columns are Fractions in lowest terms, so
+    no precision is lost however deep the tree.
 
     Args:
         taller: List of columns.
         shorter: List of columns.
 
     Returns:
-        List of two lists. The first is a list of the new taller columns,
-        constructed out of the given shorter columns. The second is a list of
-        the new shorter columns, constructed out of the given taller columns.
+        Tuple of two tuples of columns, as for next_layer.
     """
-    new_taller, new_shorter = [], []
+    n = len(taller)
+    new_taller, new_shorter = [None] * (2*n), [None] * (2*n)
+
+    for i, (tall_col, short_col) in enumerate(zip(taller, shorter)):
+        (new_taller[2*i], new_taller[2*i + 1],
+         new_shorter[2*i], new_shorter[2*i + 1]) = reverse_columns(
+            tall_col, short_col, EXACT_PARAMS)
 
-    for tall_col, short_col in zip(taller, shorter):
-        tall_l, tall_r, short_l, short_r = reverse_columns(tall_col, short_col)
-        new_taller += [tall_l, tall_r]
-        new_shorter += [short_l, short_r]
+    return tuple(new_taller), tuple(new_shorter)
 
-    return [new_taller, new_shorter]
+
+def _freeze(first_layer):
+    """Returns first_layer as nested tuples, so that it can key the cache."""
+    return tuple(tuple(tuple(col) for col in cols) for cols in first_layer)
+
+
+def clear_tree_cache():
+    """Frees the layers cached by simpson_tree and draw_layers.
+
+    Deep trees are large: a layer k deep holds 2^k columns. Call this once
+    done with them.
+    """
+    _simpson_layers.cache_clear()
 
 
 def simpson_tree(first_layer, k):
     """Returns a Simpson tree, k layers deep.
 
+    Trees are cached, so asking again for the same tree, or for a deeper tree
+    with the same first layer, reuses the layers already generated. The
+    cache keeps the layers alive until clear_tree_cache is called.
+
     Args:
         first_layer: List of two lists, the two initial columns.
         k: The depth of the tree to be generated.
 
     Returns:
-        A Simpson tree, which is a dictionary, mapping an index to the
-        corresponding layer in the tree.
+        A Simpson tree, which is a list of its layers, first layer first.
+        Each layer is a tuple of two arrays of columns; see next_layer. The
+        arrays are copies, free to modify without affecting the cache.
     """
-    tree = {1 : first_layer}
-
-    for i in range(2, k+1):
-        taller, shorter = tree[i-1]
-        tree[i] = next_layer(taller, shorter)
+    layers = _simpson_layers(_freeze(first_layer), k)
 
-    return tree
+    return [tuple(cols.copy() for cols in layer) for layer in layers]
 
 
-def cum_steps(lst):
-    """Returns a stream of pairs, overlapping, in the accumulated list.
-
-    For example, [1, 2, 3, 4] -> (0, 1), (1, 3), (3, 6), (6, 10).
-    """
-    return more_itertools.pairwise(
-        itertools.accumulate([0] + lst))
+def draw_layer_into(ax, layer):
+    """Visualizes a layer in a Simpson tree on the given axes.
 
-
-def draw_layer(layer):
-    """Creates a matplotlib figure to visualize a layer in a Simpson tree.
+    Clears the axes first, so the same axes can be reused for many layers.
 
     Args:
-        layer: List of two lists, a layer in a Simpson tree.
+        ax: matplotlib axes to draw on.
+        layer: Pair of lists (or arrays) of columns, a layer in a
+          Simpson tree.
     """
 
     colors = ['orange', 'lightgreen', 'yellow', 'hotpink',
@@ -129,28 +259,78 @@ def draw_layer(layer):
               'cyan', 'lightsalmon', 'thistle', 'gainsboro',
               'lavenderblush', 'goldenrod', 'lightskyblue', 'greenyellow']
 
-    taller, shorter = layer
-    heights = [tall[0] for tall in taller] + [short[0] for short in shorter]
-    widths = [tall[1] for tall in taller] + [short[1] for short in shorter]
+    heights, widths = np.concatenate(
+        [np.asarray(cols, dtype=np.float64) for cols in layer]).T
     n = len(heights)
-    xx = cum_steps(widths)
 
-    fig, ax = plt.subplots()
+    # the left and right edges of the columns, placed side by side
+    edges = np.empty(n + 1)
+    edges[0] = 0
+    np.cumsum(widths, out=edges[1:])
+    x1, x2 = edges[:-1], edges[1:]
 
-    for (x1, x2), height, i in zip(xx, heights, itertools.count()):
-        hatch = 'x' if i >= n/2 else ''
-        ax.fill_between([x1, x2], 0, height,
-                        hatch=hatch, facecolor=colors[i % (n//2)])
+    zeros = np.zeros(n)
+    rects = np.stack([x1, zeros, x1, heights, x2, heights, x2, zeros],
+                     axis=1).reshape(n, 4, 2)
+
+    # Counterparts share a color, cycling through the colors if need be.
+    facecolors = [colors[i % len(colors)] for i in range(n//2)]
+
+    ax.cla()
+
+    # Draw all the taller columns as one collection, and all the shorter
+    #   columns, hatched, as another.
+    for half, hatch in ((rects[:n//2], ''), (rects[n//2:], 'x')):
+        ax.add_collection(
+            PolyCollection(half, hatch=hatch, facecolors=facecolors))
+    ax.autoscale_view()
 
     ax.set_xlabel('proportion in sub-population')
     ax.set_ylabel('recovery rate')
     ax.set_ylim([0, 1])
 
+
+def draw_layer(layer):
+    """Creates a matplotlib figure to visualize a layer in a Simpson tree.
+
+    Args:
+        layer: Pair of lists (or arrays) of columns, a layer in a
+          Simpson tree.
+    """
+    fig, ax = plt.subplots()
+    draw_layer_into(ax, layer)
+
     return fig, ax
 
 
-def draw_layers(first_layer, k):
-    """Creates multiple matplotlib figures to visualize each layer in a Simpson tree.
+def _offscreen_axes():
+    """Returns axes on a new figure drawn by Agg, bypassing pyplot."""
+    fig = Figure()
+    FigureCanvasAgg(fig)
+
+    return fig.add_subplot()
+
+
+def draw_layer_to_file(layer, path):
+    """Saves an image visualizing a layer in a Simpson tree.
+
+    Draws off-screen, without pyplot, so no figure is left open.
+
+    Args:
+        layer: Pair of lists (or arrays) of columns, a layer in a
+          Simpson tree.
+        path: Where to save the image, e.g. 'layer.png'.
+    """
+    ax = _offscreen_axes()
+    draw_layer_into(ax, layer)
+    ax.figure.savefig(path)
+
+
+def draw_layers(first_layer, k, outdir=None, num_procs=1):
+    """Visualizes each layer in a Simpson tree, as figures or as image files.
+
+    By default, creates a matplotlib figure per layer. If outdir is given,
+    saves an image per layer instead, without creating any figures.
 
     Args:
         first_layer: List of two lists, each containing a single column.
@@ -158,12 +338,43 @@ def draw_layers(first_layer, k):
           control groups.
         k: The number of images to draw, one for each layer in the
           tree to be generated.
+        outdir: Optional directory, created if need be. If given, each
+          layer is drawn off-screen and saved to outdir as layer_1.png,
+          layer_2.png, etc.
+        num_procs: The number of processes to save the layers with. Only
+          applies when outdir is given. None means one per CPU.
+
+    Raises:
+        ValueError: If num_procs is other than 1 but outdir isn't given.
     """
-    tree = simpson_tree(first_layer, k)
-
-    for i in tree:
-        # Because the taller columns come first in each layer, we need to
-        #   reverse every other layer, so that (e.g.) the treatment population
-        #   stays on the left and the control population stays on the right.
-        layer = tree[i][::-1] if i%2 == 0 else tree[i]
-        draw_layer(layer)
\ No newline at end of file
+    if outdir is None and num_procs != 1:
+        raise ValueError('num_procs only applies when saving to an outdir')
+
+    # only reads the layers, so can use the cached arrays without copying
+    tree = _simpson_layers(_freeze(first_layer), k)
+
+    # Because the taller columns come first in each layer, we need to
+    #   reverse every other layer, so that (e.g.) the treatment population
+    #   stays on the left and the control population stays on the right.
+    layers = [layer[::-1] if i%2 == 0 else layer
+              for i, layer in enumerate(tree, 1)]
+
+    if outdir is None:
+        for layer in layers:
+            draw_layer(layer)
+        return
+
+    os.makedirs(outdir, exist_ok=True)
+
+    if num_procs == 1:
+        ax = _offscreen_axes()
+        for i, layer in enumerate(layers, 1):
+            draw_layer_into(ax, layer)
+            ax.figure.savefig(os.path.join(outdir, f'layer_{i}.png'))
+
+    else:
+        # matplotlib isn't thread-safe, so use processes
+        jobs = [(layer, os.path.join(outdir, f'layer_{i}.png'))
+                for i, layer in enumerate(layers, 1)]
+        with multiprocessing.Pool(num_procs) as pool:
+            pool.starmap(draw_layer_to_file, jobs)
@@ -0,0 +1,69 @@
+import fractions
+import os
+import subprocess
+import sys
+import textwrap
+
+import numpy as np
+import pytest
+
+import simpson_reversals as sr
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FIRST_LAYER = [[(30/50, 50/100)], [(20/50, 50/100)]]
+
+
+def test_draw_layers_in_pool_exits(tmp_path):
+    # Run in a fresh interpreter: a hung pool only shows up at exit.
+    script = textwrap.dedent(f"""
+        import sys
+        sys.path.insert(0, {HERE!r})
+        import simpson_reversals as sr
+        sr.simpson_tree({FIRST_LAYER!r}, 3)
+        sr.draw_layers({FIRST_LAYER!r}, 6, outdir={str(tmp_path)!r},
+                       num_procs=2)
+    """)
+    result = subprocess.run([sys.executable, '-c', script], timeout=60)
+
+    assert result.returncode == 0
+    assert sorted(os.listdir(tmp_path)) == [f'layer_{i}.png'
+                                            for i in range(1, 7)]
+
+
+def test_next_layer_exact_matches_next_layer():
+    exact = [[tuple(fractions.Fraction(x).limit_denominator() for x in col)
+              for col in cols] for cols in FIRST_LAYER]
+    tree = sr.simpson_tree(FIRST_LAYER, 8)
+
+    for layer in tree[1:]:
+        exact = sr.next_layer_exact(*exact)
+        for exact_cols, cols in zip(exact, layer):
+            assert all(isinstance(x, fractions.Fraction)
+                       for col in exact_cols for x in col)
+            assert np.allclose(np.array(exact_cols, dtype=np.float64), cols)
+
+        # the widths still sum to 1 exactly
+        assert sum(w for cols in exact for _, w in cols) == 1
+
+
+def test_simpson_tree_returns_copies_of_cached_layers():
+    tree = sr.simpson_tree(FIRST_LAYER, 4)
+    expected = tree[-1][0].copy()
+
+    tree[-1][0][:] = 0
+    assert np.array_equal(sr.simpson_tree(FIRST_LAYER, 4)[-1][0], expected)
+
+    sr.clear_tree_cache()
+    assert sr._simpson_layers.cache_info().currsize == 0
+
+
+def test_draw_layers_creates_outdir(tmp_path):
+    outdir = tmp_path / 'figures' / 'layers'
+    sr.draw_layers(FIRST_LAYER, 2, outdir=str(outdir))
+
+    assert sorted(os.listdir(outdir)) == ['layer_1.png', 'layer_2.png']
+
+
+def test_draw_layers_rejects_num_procs_without_outdir():
+    with pytest.raises(ValueError):
+        sr.draw_layers(FIRST_LAYER, 2, num_procs=2)